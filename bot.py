@@ -1,39 +1,230 @@
 import os
+import re
+import sys
+import secrets
 import json
+import asyncio
 import logging
-from datetime import datetime
+import functools
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import anthropic
+import httpx
 import base64
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm
-from reportlab.lib.enums import TA_CENTER
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
 from io import BytesIO
+from PIL import Image
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
+PUBLIC_URL = os.getenv('PUBLIC_URL')
+PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+client = anthropic.AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    max_retries=2,
+    timeout=30.0,
+    http_client=anthropic.DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=20))
+)
+
+DB_FILE = 'receipts.db'
+LEGACY_DATA_FILE = 'receipts_data.json'
+
+conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+conn.row_factory = sqlite3.Row
+db_lock = threading.Lock()
+
+_report_cache = None
+
+MODEL = "claude-sonnet-4-20250514"
+PROMPT_VERSION = 1
+EXTRACTION_ATTEMPTS = 3
+PHOTO_BATCH_DELAY = 0.75
+MAX_BATCH_SIZE = 5
+
+pending_photos = {}
+batch_tasks = set()
+
+RECENT_PHOTOS_SIZE = 256
+recent_photos = OrderedDict()
+
+MAX_IMAGE_PIXELS = 1_300_000
+JPEG_QUALITY = 85
 
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+PDF_SPOOL_MAX_SIZE = 1024 * 1024
+pdf_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='pdf')
 
-DATA_FILE = 'receipts_data.json'
+SEP = "=" * 30
+LIST_PAGE_SIZE = 30
+MESSAGE_CHUNK_SIZE = 3900
 
-def load_receipts():
+_HEADER = ('Date', 'Carburant', 'Litres', 'Prix/L', 'TVA', 'Total')
+
+JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+RECEIPT_PROMPT = "Analyse ce ticket de station-service et extrait les informations. Réponds UNIQUEMENT avec un JSON: {\"date\": \"YYYY-MM-DD\", \"liters\": 0.00, \"price_per_liter\": 0.000, \"vat\": 0.00, \"total_price\": 0.00, \"fuel_type\": \"GAZOLE\"}"
+BATCH_RECEIPT_PROMPT = "Analyse chacun de ces tickets de station-service et extrait les informations. Réponds UNIQUEMENT avec un tableau JSON contenant un objet par image, dans l'ordre des images: [{\"date\": \"YYYY-MM-DD\", \"liters\": 0.00, \"price_per_liter\": 0.000, \"vat\": 0.00, \"total_price\": 0.00, \"fuel_type\": \"GAZOLE\"}]"
+
+class Receipt(msgspec.Struct):
+    date: date
+    liters: float
+    price_per_liter: float
+    vat: float
+    total_price: float
+    fuel_type: str
+
+def init_db():
+    with db_lock, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS receipts ("
+            "id INTEGER PRIMARY KEY, date TEXT NOT NULL, liters REAL, price_per_liter REAL, "
+            "vat REAL, total_price REAL, fuel_type TEXT, timestamp TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts(date)")
+        conn.execute("CREATE TABLE IF NOT EXISTS extraction_cache (key TEXT PRIMARY KEY, receipt TEXT NOT NULL)")
+
+def migrate_legacy_receipts():
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(LEGACY_DATA_FILE, 'r', encoding='utf-8') as f:
+            receipts = json.load(f)
     except FileNotFoundError:
-        return []
+        return
+    
+    valid_receipts = []
+    for receipt in receipts:
+        try:
+            receipt['date'] = datetime.strptime(receipt['date'], '%Y-%m-%d').date().isoformat()
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ticket #{receipt.get('id')} ignoré lors de la migration: {e}")
+            continue
+        valid_receipts.append(receipt)
+    
+    with db_lock, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO receipts (id, date, liters, price_per_liter, vat, total_price, fuel_type, timestamp) "
+            "VALUES (:id, :date, :liters, :price_per_liter, :vat, :total_price, :fuel_type, :timestamp)",
+            valid_receipts
+        )
+    os.remove(LEGACY_DATA_FILE)
+    logger.info(f"{len(valid_receipts)} tickets migrés de {LEGACY_DATA_FILE} vers {DB_FILE}")
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_str):
+    return date.fromisoformat(date_str)
+
+def year_filter(year):
+    if not year:
+        return "", ()
+    return "WHERE date >= ? AND date < ? ", (f"{year:04d}-01-01", f"{year + 1:04d}-01-01")
+
+def load_report(year=None):
+    global _report_cache
+    with db_lock:
+        mtime = os.stat(DB_FILE).st_mtime_ns
+        if _report_cache and _report_cache[:2] == (mtime, year):
+            return _report_cache[2]
+        
+        where, params = year_filter(year)
+        receipts = conn.execute(f"SELECT * FROM receipts {where}ORDER BY date, id", params).fetchall()
+        report = (receipts, select_monthly_totals(year))
+        _report_cache = (mtime, year, report)
+        return report
+
+def count_receipts():
+    with db_lock:
+        return conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+def load_receipts_page(limit, offset):
+    with db_lock:
+        return conn.execute(
+            "SELECT * FROM receipts ORDER BY date DESC, id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+
+def select_monthly_totals(year):
+    where, params = year_filter(year)
+    return conn.execute(
+        "SELECT strftime('%Y-%m', date) AS month, COUNT(*) AS count, SUM(liters) AS total_liters, "
+        f"SUM(vat) AS total_vat, SUM(total_price) AS total_price FROM receipts {where}"
+        "GROUP BY month ORDER BY month DESC",
+        params
+    ).fetchall()
+
+def load_monthly_totals(year=None):
+    with db_lock:
+        return select_monthly_totals(year)
+
+def insert_receipt(receipt, timestamp):
+    global _report_cache
+    with db_lock, conn:
+        _report_cache = None
+        cursor = conn.execute(
+            "INSERT INTO receipts (date, liters, price_per_liter, vat, total_price, fuel_type, timestamp) "
+            "VALUES (:date, :liters, :price_per_liter, :vat, :total_price, :fuel_type, :timestamp)",
+            {**msgspec.to_builtins(receipt), 'timestamp': timestamp}
+        )
+    return cursor.lastrowid
+
+def clear_receipts():
+    global _report_cache
+    with db_lock, conn:
+        _report_cache = None
+        conn.execute("DELETE FROM receipts")
+
+def load_cached_extraction(cache_key):
+    with db_lock:
+        row = conn.execute("SELECT receipt FROM extraction_cache WHERE key = ?", (cache_key,)).fetchone()
+    if not row:
+        return None
+    
+    try:
+        return msgspec.json.decode(row['receipt'], type=Receipt)
+    except msgspec.ValidationError as e:
+        logger.warning(f"Analyse en cache invalide, ignorée: {e}")
+        return None
+
+def save_cached_extraction(cache_key, receipt):
+    with db_lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO extraction_cache (key, receipt) VALUES (?, ?)",
+            (cache_key, msgspec.json.encode(receipt).decode('utf-8'))
+        )
 
-def save_receipts(receipts):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(receipts, f, ensure_ascii=False, indent=2)
+def prepare_receipt_image(image_file):
+    img = Image.open(image_file)
+    
+    pixels = img.width * img.height
+    if pixels <= MAX_IMAGE_PIXELS and img.format == 'JPEG':
+        return image_file.getvalue()
+    
+    img = img.convert('RGB')
+    if pixels > MAX_IMAGE_PIXELS:
+        scale = (MAX_IMAGE_PIXELS / pixels) ** 0.5
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def extraction_cache_key(image_bytes):
+    return f"{MODEL}:{PROMPT_VERSION}:{hashlib.sha256(image_bytes).hexdigest()}"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -46,72 +237,162 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Je vais analyser automatiquement chaque ticket !"
     )
 
-async def analyze_receipt_image(image_data):
+def image_block(image_bytes):
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": "image/jpeg",
+            "data": base64.b64encode(image_bytes).decode('ascii'),
+        },
+    }
+
+async def request_extraction(images, prompt, result_type, pattern):
+    content = [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+    if len(images) == 1:
+        content.append(image_block(images[0]))
+    else:
+        for index, image_bytes in enumerate(images, start=1):
+            content.append({"type": "text", "text": f"Image {index}:"})
+            content.append(image_block(image_bytes))
+    messages = [{"role": "user", "content": content}]
+    
     try:
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1024,
-            messages=[
-                {
+        for attempt in range(EXTRACTION_ATTEMPTS):
+            message = await client.messages.create(
+                model=MODEL,
+                max_tokens=1024 * len(images),
+                extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+                messages=messages,
+            )
+            
+            logger.info(f"Cache prompt: {getattr(message.usage, 'cache_read_input_tokens', 0)} tokens lus")
+            
+            response_text = message.content[0].text
+            match = pattern.search(response_text)
+            if not match:
+                logger.warning("Aucun JSON trouvé dans la réponse")
+                return None
+            
+            try:
+                return msgspec.json.decode(match.group(0), type=result_type)
+            except msgspec.DecodeError as e:
+                logger.warning(f"JSON invalide (tentative {attempt + 1}/{EXTRACTION_ATTEMPTS}): {e}")
+                if attempt + 1 == EXTRACTION_ATTEMPTS:
+                    return None
+                messages.append({"role": "assistant", "content": response_text})
+                messages.append({
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": image_data,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": "Analyse ce ticket de station-service et extrait les informations. Réponds UNIQUEMENT avec un JSON: {\"date\": \"YYYY-MM-DD\", \"liters\": 0.00, \"price_per_liter\": 0.000, \"vat\": 0.00, \"total_price\": 0.00, \"fuel_type\": \"GAZOLE\"}"
-                        }
-                    ],
-                }
-            ],
-        )
-        
-        response_text = message.content[0].text.strip()
-        response_text = response_text.replace('```json', '').replace('```', '').strip()
-        
-        return json.loads(response_text)
+                    "content": f"Ton JSON n'a pas pu être lu ({e}). Réponds UNIQUEMENT avec un JSON valide."
+                })
+                await asyncio.sleep(1.0 * (attempt + 1))
     except Exception as e:
         logger.error(f"Erreur analyse: {e}")
         return None
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📸 Photo reçue ! Analyse en cours...")
+async def analyze_receipt_image(image_bytes):
+    return await request_extraction([image_bytes], RECEIPT_PROMPT, Receipt, JSON_OBJECT_RE)
+
+async def analyze_receipt_images(images):
+    results = await request_extraction(images, BATCH_RECEIPT_PROMPT, list[Receipt], JSON_ARRAY_RE)
+    
+    if results is None or len(results) != len(images):
+        logger.warning(f"Analyse groupée de {len(images)} tickets échouée, analyse individuelle")
+        return await asyncio.gather(*(analyze_receipt_image(image_bytes) for image_bytes in images))
+    return results
+
+def start_photo_batch(chat_id):
+    batch, timer = pending_photos.pop(chat_id)
+    timer.cancel()
+    task = asyncio.create_task(flush_photo_batch(batch))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+async def flush_photo_batch(batch):
+    images = [image_bytes for _, image_bytes in batch]
     
+    try:
+        if len(images) == 1:
+            results = [await analyze_receipt_image(images[0])]
+        else:
+            results = await analyze_receipt_images(images)
+    except Exception as e:
+        logger.error(f"Erreur analyse groupée: {e}")
+        results = [None] * len(images)
+    
+    for (future, _), result in zip(batch, results):
+        if not future.done():
+            future.set_result(result)
+
+async def analyze_receipt_batched(chat_id, image_bytes):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    if chat_id not in pending_photos:
+        pending_photos[chat_id] = ([], loop.call_later(PHOTO_BATCH_DELAY, start_photo_batch, chat_id))
+    
+    batch, _ = pending_photos[chat_id]
+    batch.append((future, image_bytes))
+    if len(batch) >= MAX_BATCH_SIZE:
+        start_photo_batch(chat_id)
+    return await future
+
+async def extract_receipt(update, context, photo):
+    _, file = await asyncio.gather(
+        update.message.reply_text("📸 Photo reçue ! Analyse en cours..."),
+        context.bot.get_file(photo.file_id)
+    )
+    image_file = BytesIO()
+    await file.download_to_memory(out=image_file)
+    
+    with image_file.getbuffer() as image_view:
+        cache_key = extraction_cache_key(image_view)
+    cached_receipt = await asyncio.to_thread(load_cached_extraction, cache_key)
+    
+    if cached_receipt:
+        logger.info(f"Ticket déjà analysé: {cache_key}")
+        return cached_receipt
+    
+    image_file.seek(0)
+    jpeg_bytes = await asyncio.to_thread(prepare_receipt_image, image_file)
+    receipt_data = await analyze_receipt_batched(update.effective_chat.id, jpeg_bytes)
+    
+    if receipt_data:
+        await asyncio.to_thread(save_cached_extraction, cache_key, receipt_data)
+    return receipt_data
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        receipt_data = await analyze_receipt_image(image_base64)
+        receipt_data = recent_photos.get(photo.file_unique_id)
         
-        if not receipt_data:
-            await update.message.reply_text("❌ Je n'ai pas pu analyser ce ticket.")
-            return
+        if receipt_data:
+            recent_photos.move_to_end(photo.file_unique_id)
+            logger.info(f"Photo déjà reçue: {photo.file_unique_id}")
+            await update.message.reply_text("📸 Photo reçue ! Analyse en cours...")
+        else:
+            receipt_data = await extract_receipt(update, context, photo)
+            
+            if not receipt_data:
+                await update.message.reply_text("❌ Je n'ai pas pu analyser ce ticket.")
+                return
+            
+            recent_photos[photo.file_unique_id] = receipt_data
+            if len(recent_photos) > RECENT_PHOTOS_SIZE:
+                recent_photos.popitem(last=False)
         
-        receipts = load_receipts()
-        receipt_data['id'] = len(receipts) + 1
-        receipt_data['timestamp'] = datetime.now().isoformat()
-        receipts.append(receipt_data)
-        save_receipts(receipts)
+        receipt_id = await asyncio.to_thread(insert_receipt, receipt_data, datetime.now().isoformat())
         
-        date_obj = datetime.strptime(receipt_data['date'], '%Y-%m-%d')
-        formatted_date = date_obj.strftime('%d/%m/%Y')
+        formatted_date = receipt_data.date.strftime('%d/%m/%Y')
         
-        response = f"""✅ Ticket analysé et ajouté !
+        response = f"""✅ Ticket #{receipt_id} analysé et ajouté !
 
 📅 Date: {formatted_date}
-⛽ Carburant: {receipt_data['fuel_type']}
-📊 Quantité: {receipt_data['liters']:.2f} L
-💶 Prix/L: {receipt_data['price_per_liter']:.3f} €
-🧾 TVA: {receipt_data['vat']:.2f} €
-💰 Total: {receipt_data['total_price']:.2f} €"""
+⛽ Carburant: {receipt_data.fuel_type}
+📊 Quantité: {receipt_data.liters:.2f} L
+💶 Prix/L: {receipt_data.price_per_liter:.3f} €
+🧾 TVA: {receipt_data.vat:.2f} €
+💰 Total: {receipt_data.total_price:.2f} €"""
         
         await update.message.reply_text(response)
         
@@ -120,87 +401,102 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Erreur: {str(e)}")
 
 async def show_total(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    receipts = load_receipts()
+    monthly_data = await asyncio.to_thread(load_monthly_totals)
     
-    if not receipts:
+    if not monthly_data:
         await update.message.reply_text("📭 Aucun ticket enregistré.")
         return
     
-    monthly_data = {}
-    for receipt in receipts:
-        date_obj = datetime.strptime(receipt['date'], '%Y-%m-%d')
-        month_key = date_obj.strftime('%Y-%m')
-        month_name = date_obj.strftime('%B %Y')
-        
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {
-                'name': month_name,
-                'count': 0,
-                'total_liters': 0,
-                'total_vat': 0,
-                'total_price': 0
-            }
-        
-        monthly_data[month_key]['count'] += 1
-        monthly_data[month_key]['total_liters'] += receipt['liters']
-        monthly_data[month_key]['total_vat'] += receipt['vat']
-        monthly_data[month_key]['total_price'] += receipt['total_price']
-    
-    response = "📊 TOTAUX MENSUELS\n" + "="*30 + "\n\n"
-    
-    for month_key in sorted(monthly_data.keys(), reverse=True):
-        data = monthly_data[month_key]
-        response += f"📅 {data['name']}\n"
-        response += f"   • Tickets: {data['count']}\n"
-        response += f"   • Litres: {data['total_liters']:.2f} L\n"
-        response += f"   • TVA: {data['total_vat']:.2f} €\n"
-        response += f"   • Total: {data['total_price']:.2f} €\n\n"
-    
-    total_tickets = len(receipts)
-    total_liters = sum(r['liters'] for r in receipts)
-    total_vat = sum(r['vat'] for r in receipts)
-    total_price = sum(r['total_price'] for r in receipts)
-    
-    response += "="*30 + "\n"
-    response += f"💰 TOTAL GÉNÉRAL\n"
-    response += f"   • Tickets: {total_tickets}\n"
-    response += f"   • Litres: {total_liters:.2f} L\n"
-    response += f"   • TVA: {total_vat:.2f} €\n"
-    response += f"   • Total: {total_price:.2f} €\n"
-    
-    await update.message.reply_text(response)
+    parts = ["📊 TOTAUX MENSUELS\n", SEP, "\n\n"]
+    append = parts.append
+    
+    for data in monthly_data:
+        month_name = parse_date(f"{data['month']}-01").strftime('%B %Y')
+        append(f"📅 {month_name}\n")
+        append(f"   • Tickets: {data['count']}\n")
+        append(f"   • Litres: {data['total_liters']:.2f} L\n")
+        append(f"   • TVA: {data['total_vat']:.2f} €\n")
+        append(f"   • Total: {data['total_price']:.2f} €\n\n")
+    
+    total_tickets = sum(m['count'] for m in monthly_data)
+    total_liters = sum(m['total_liters'] for m in monthly_data)
+    total_vat = sum(m['total_vat'] for m in monthly_data)
+    total_price = sum(m['total_price'] for m in monthly_data)
+    
+    append(SEP + "\n")
+    append(f"💰 TOTAL GÉNÉRAL\n")
+    append(f"   • Tickets: {total_tickets}\n")
+    append(f"   • Litres: {total_liters:.2f} L\n")
+    append(f"   • TVA: {total_vat:.2f} €\n")
+    append(f"   • Total: {total_price:.2f} €\n")
+    
+    await update.message.reply_text("".join(parts))
 
 async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    receipts = load_receipts()
+    receipt_count = await asyncio.to_thread(count_receipts)
     
-    if not receipts:
+    if not receipt_count:
         await update.message.reply_text("📭 Aucun ticket enregistré.")
         return
     
-    response = "📋 LISTE DES TICKETS\n" + "="*30 + "\n\n"
+    page = 1
+    if context.args and len(context.args) > 0:
+        try:
+            page = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Format invalide. Utilisez: /liste ou /liste 2")
+            return
+    
+    total_pages = (receipt_count + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+    if page < 1 or page > total_pages:
+        await update.message.reply_text(f"❌ Page inexistante. Pages disponibles: 1 à {total_pages}")
+        return
+    
+    page_receipts = await asyncio.to_thread(load_receipts_page, LIST_PAGE_SIZE, (page - 1) * LIST_PAGE_SIZE)
+    
+    chunks = []
+    header = f"📋 LISTE DES TICKETS\n{SEP}\n\n"
+    parts, size = [header], len(header)
     
-    for receipt in sorted(receipts, key=lambda x: x['date'], reverse=True):
-        date_obj = datetime.strptime(receipt['date'], '%Y-%m-%d')
+    for receipt in page_receipts:
+        date_obj = parse_date(receipt['date'])
         formatted_date = date_obj.strftime('%d/%m/%Y')
-        response += f"#{receipt['id']} - {formatted_date}\n"
-        response += f"   {receipt['fuel_type']} | {receipt['liters']:.2f}L | {receipt['total_price']:.2f}€\n\n"
+        record = (
+            f"#{receipt['id']} - {formatted_date}\n"
+            f"   {receipt['fuel_type']} | {receipt['liters']:.2f}L | {receipt['total_price']:.2f}€\n\n"
+        )
+        if size + len(record) > MESSAGE_CHUNK_SIZE:
+            chunks.append("".join(parts))
+            parts, size = [header], len(header)
+        parts.append(record)
+        size += len(record)
     
-    if len(response) > 4000:
-        parts = [response[i:i+4000] for i in range(0, len(response), 4000)]
-        for part in parts:
-            await update.message.reply_text(part)
-    else:
-        await update.message.reply_text(response)
+    parts.append(f"Page {page}/{total_pages}")
+    if page < total_pages:
+        parts.append(f" — /liste {page + 1} pour la suite")
+    chunks.append("".join(parts))
+    
+    for chunk in chunks:
+        await update.message.reply_text(chunk)
 
-def generate_pdf(receipts, year=None):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
-    elements = []
-    styles = getSampleStyleSheet()
+@functools.cache
+def load_pdf_support():
+    global colors, A4, SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+    global cm, _STYLES, _TITLE_STYLE, _SUBTITLE_STYLE, _TABLE_STYLE, _SUMMARY_TABLE_STYLE
+    global _COL_WIDTHS, _SUMMARY_COL_WIDTHS
+    
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
+    from reportlab.lib.enums import TA_CENTER
     
-    title_style = ParagraphStyle(
+    _STYLES = getSampleStyleSheet()
+    
+    _TITLE_STYLE = ParagraphStyle(
         'CustomTitle',
-        parent=styles['Heading1'],
+        parent=_STYLES['Heading1'],
         fontSize=24,
         textColor=colors.HexColor('#1e40af'),
         spaceAfter=30,
@@ -208,9 +504,9 @@ def generate_pdf(receipts, year=None):
         fontName='Helvetica-Bold'
     )
     
-    subtitle_style = ParagraphStyle(
+    _SUBTITLE_STYLE = ParagraphStyle(
         'CustomSubtitle',
-        parent=styles['Heading2'],
+        parent=_STYLES['Heading2'],
         fontSize=16,
         textColor=colors.HexColor('#1e40af'),
         spaceAfter=12,
@@ -218,96 +514,102 @@ def generate_pdf(receipts, year=None):
         fontName='Helvetica-Bold'
     )
     
+    _TABLE_STYLE = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1e40af')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
+        ('ALIGN', (2, 1), (-1, -1), 'RIGHT'),
+        ('FONTSIZE', (0, 1), (-1, -2), 9),
+        ('GRID', (0, 0), (-1, -2), 1, colors.grey),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#dbeafe')),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+    ])
+    
+    _SUMMARY_TABLE_STYLE = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -2), colors.beige),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#1e40af')),
+        ('TEXTCOLOR', (0, -1), (-1, -1), colors.whitesmoke),
+        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, -1), (-1, -1), 14),
+        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+    ])
+    
+    _COL_WIDTHS = [3*cm, 2.5*cm, 2.5*cm, 2.5*cm, 2.5*cm, 2.5*cm]
+    _SUMMARY_COL_WIDTHS = [10*cm, 6*cm]
+
+def generate_pdf(receipts, monthly_totals, year=None):
+    load_pdf_support()
+    
+    buffer = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE, mode='w+b')
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm)
+    elements = []
+    
     if year:
-        receipts = [r for r in receipts if datetime.strptime(r['date'], '%Y-%m-%d').year == year]
         title_text = f"Rapport Carburant {year}"
     else:
         title_text = "Rapport Carburant - Tous les tickets"
     
     if not receipts:
-        elements.append(Paragraph(title_text, title_style))
+        elements.append(Paragraph(title_text, _TITLE_STYLE))
         elements.append(Spacer(1, 20))
-        elements.append(Paragraph("Aucun ticket trouvé.", styles['Normal']))
+        elements.append(Paragraph("Aucun ticket trouvé.", _STYLES['Normal']))
         doc.build(elements)
         buffer.seek(0)
-        return buffer
+        return buffer, 0
     
-    elements.append(Paragraph(title_text, title_style))
-    elements.append(Paragraph(f"Généré le {datetime.now().strftime('%d/%m/%Y')}", styles['Normal']))
+    elements.append(Paragraph(title_text, _TITLE_STYLE))
+    elements.append(Paragraph(f"Généré le {datetime.now().strftime('%d/%m/%Y')}", _STYLES['Normal']))
     elements.append(Spacer(1, 30))
     
-    monthly_data = {}
+    receipts_by_month = defaultdict(list)
     for receipt in receipts:
-        date_obj = datetime.strptime(receipt['date'], '%Y-%m-%d')
-        month_key = date_obj.strftime('%Y-%m')
-        month_name = date_obj.strftime('%B %Y').title()
-        
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {
-                'name': month_name,
-                'receipts': [],
-                'totals': {'liters': 0, 'vat': 0, 'total_price': 0}
-            }
-        
-        monthly_data[month_key]['receipts'].append(receipt)
-        monthly_data[month_key]['totals']['liters'] += receipt['liters']
-        monthly_data[month_key]['totals']['vat'] += receipt['vat']
-        monthly_data[month_key]['totals']['total_price'] += receipt['total_price']
+        receipts_by_month[receipt['date'][:7]].append(receipt)
     
-    for month_key in sorted(monthly_data.keys(), reverse=True):
-        data = monthly_data[month_key]
+    for data in monthly_totals:
+        month_name = parse_date(f"{data['month']}-01").strftime('%B %Y').title()
         
-        elements.append(Paragraph(data['name'], subtitle_style))
+        elements.append(Paragraph(month_name, _SUBTITLE_STYLE))
         elements.append(Spacer(1, 10))
         
-        table_data = [['Date', 'Carburant', 'Litres', 'Prix/L', 'TVA', 'Total']]
-        
-        for receipt in sorted(data['receipts'], key=lambda x: x['date']):
-            date_obj = datetime.strptime(receipt['date'], '%Y-%m-%d')
-            table_data.append([
-                date_obj.strftime('%d/%m/%Y'),
+        table_data = [_HEADER]
+        table_data += [
+            [
+                parse_date(receipt['date']).strftime('%d/%m/%Y'),
                 receipt['fuel_type'],
                 f"{receipt['liters']:.2f} L",
                 f"{receipt['price_per_liter']:.3f} €",
                 f"{receipt['vat']:.2f} €",
                 f"{receipt['total_price']:.2f} €"
-            ])
-        
+            ]
+            for receipt in receipts_by_month[data['month']]
+        ]
         table_data.append([
             'TOTAL',
             '',
-            f"{data['totals']['liters']:.2f} L",
+            f"{data['total_liters']:.2f} L",
             '',
-            f"{data['totals']['vat']:.2f} €",
-            f"{data['totals']['total_price']:.2f} €"
+            f"{data['total_vat']:.2f} €",
+            f"{data['total_price']:.2f} €"
         ])
         
-        table = Table(table_data, colWidths=[3*cm, 2.5*cm, 2.5*cm, 2.5*cm, 2.5*cm, 2.5*cm])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1e40af')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-            ('ALIGN', (2, 1), (-1, -1), 'RIGHT'),
-            ('FONTSIZE', (0, 1), (-1, -2), 9),
-            ('GRID', (0, 0), (-1, -2), 1, colors.grey),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#dbeafe')),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ]))
+        table = Table(table_data, colWidths=_COL_WIDTHS)
+        table.setStyle(_TABLE_STYLE)
         
         elements.append(table)
         elements.append(Spacer(1, 30))
     
     elements.append(PageBreak())
-    elements.append(Paragraph("RÉSUMÉ ANNUEL", title_style))
+    elements.append(Paragraph("RÉSUMÉ ANNUEL", _TITLE_STYLE))
     elements.append(Spacer(1, 20))
     
-    total_tickets = len(receipts)
-    total_liters = sum(r['liters'] for r in receipts)
-    total_vat = sum(r['vat'] for r in receipts)
-    total_price = sum(r['total_price'] for r in receipts)
+    total_tickets = sum(m['count'] for m in monthly_totals)
+    total_liters = sum(m['total_liters'] for m in monthly_totals)
+    total_vat = sum(m['total_vat'] for m in monthly_totals)
+    total_price = sum(m['total_price'] for m in monthly_totals)
     avg_price = total_price / total_liters if total_liters > 0 else 0
     
     summary_data = [
@@ -318,29 +620,23 @@ def generate_pdf(receipts, year=None):
         ['TOTAL', f"{total_price:.2f} €"]
     ]
     
-    summary_table = Table(summary_data, colWidths=[10*cm, 6*cm])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -2), colors.beige),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#1e40af')),
-        ('TEXTCOLOR', (0, -1), (-1, -1), colors.whitesmoke),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -1), (-1, -1), 14),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-    ]))
+    summary_table = Table(summary_data, colWidths=_SUMMARY_COL_WIDTHS)
+    summary_table.setStyle(_SUMMARY_TABLE_STYLE)
     
     elements.append(summary_table)
     doc.build(elements)
     buffer.seek(0)
-    return buffer
+    return buffer, total_tickets
 
 async def generate_pdf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📄 Génération du PDF...")
-    
+    pdf_buffer = None
     try:
-        receipts = load_receipts()
+        _, receipt_count = await asyncio.gather(
+            update.message.reply_text("📄 Génération du PDF..."),
+            asyncio.to_thread(count_receipts)
+        )
         
-        if not receipts:
+        if not receipt_count:
             await update.message.reply_text("📭 Aucun ticket enregistré !")
             return
         
@@ -352,7 +648,11 @@ async def generate_pdf_command(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("❌ Format invalide. Utilisez: /pdf ou /pdf 2025")
                 return
         
-        pdf_buffer = generate_pdf(receipts, year)
+        receipts, monthly_totals = await asyncio.to_thread(load_report, year)
+        loop = asyncio.get_running_loop()
+        pdf_buffer, ticket_count = await loop.run_in_executor(
+            pdf_executor, functools.partial(generate_pdf, receipts, monthly_totals, year=year)
+        )
         
         if year:
             filename = f"rapport_carburant_{year}.pdf"
@@ -362,16 +662,19 @@ async def generate_pdf_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_document(
             document=pdf_buffer,
             filename=filename,
-            caption="✅ Votre rapport carburant ! 📊"
+            caption=f"✅ Votre rapport carburant ! 📊 ({ticket_count} tickets)"
         )
         
     except Exception as e:
         logger.error(f"Erreur PDF: {e}")
         await update.message.reply_text(f"❌ Erreur: {str(e)}")
+    finally:
+        if pdf_buffer is not None:
+            pdf_buffer.close()
 
 async def reset_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        save_receipts([])
+        await asyncio.to_thread(clear_receipts)
         await update.message.reply_text("🗑️ Données effacées.")
     except Exception as e:
         await update.message.reply_text(f"❌ Erreur: {str(e)}")
@@ -386,7 +689,13 @@ def main():
         logger.error("Tokens manquants!")
         return
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    init_db()
+    migrate_legacy_receipts()
+    
+    if uvloop:
+        uvloop.install()
+    
+    application = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("total", show_total))
@@ -396,8 +705,19 @@ def main():
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_error_handler(error_handler)
     
-    logger.info("🤖 Bot démarré!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if PUBLIC_URL and '--dev' not in sys.argv:
+        logger.info(f"🤖 Bot démarré en webhook sur le port {PORT}!")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_SECRET,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{WEBHOOK_SECRET}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.info("🤖 Bot démarré!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()